@@ -1,18 +1,47 @@
+import asyncio
+import collections
+import datetime
+import hashlib
+import logging
 import os
+import re
+import time
 import functions_framework
-import requests
+import httpx
+import orjson
+import google.auth
 import gspread
+from google.cloud import firestore
+from gspread.utils import absolute_range_name
+from pybloom_live import ScalableBloomFilter
 import vertexai
 from vertexai.generative_models import GenerativeModel
 
+logging.basicConfig(level=logging.INFO)
+# httpx logs every request URL at INFO, and SerpAPI URLs carry the api_key.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
 PROJECT_ID = ""
 TENANT_ID = "projects/{}/tenants/{}".format(PROJECT_ID, "default")
 
 vertexai.init(project=PROJECT_ID, location="us-central1")
 model = GenerativeModel("gemini-2.5-flash")
 
+db = firestore.Client(project=PROJECT_ID or None)
+seen_ref = db.collection("gcp_jobs_seen")
+seeds_ref = db.collection("gcp_jobs_seen_seeds")
+FIRESTORE_BATCH_LIMIT = 500
+FIRESTORE_MAX_RETRIES = 3
+FIRESTORE_BACKOFF_FACTOR = 0.5
+
 SERPAPI_API_KEY = ""
 SERPAPI_URL = "https://serpapi.com/search"
+SERPAPI_CONCURRENCY = 8
+SERPAPI_TIMEOUT = httpx.Timeout(30, connect=5)
+SERPAPI_MAX_RETRIES = 3
+SERPAPI_BACKOFF_FACTOR = 0.3
+SERPAPI_RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 MAX_JOBS_TO_FETCH = 500
 RESULTS_PER_PAGE = 30
@@ -39,8 +68,40 @@ TARGET_LOCATIONS = {
     ]
 }
 
+BASE_PARAMS = {
+    "engine": "google_jobs",
+    "q": '"GCP" OR "Google Cloud Platform" OR "Google Cloud" OR "Google Cloud Engineer" OR "Google Cloud Architect" OR "Google Cloud Developer" OR "Google Cloud Specialist" OR "Google Cloud Consultant" OR "Google Cloud Professional"',
+    "api_key": SERPAPI_API_KEY,
+    "hl": "en",
+    "num": RESULTS_PER_PAGE
+}
+# Per-region SerpAPI params, built once: (filter value, params) for each filter.
+FILTER_PARAMS = {
+    worksheet_name: tuple(
+        (filter_config["value"], {**BASE_PARAMS, filter_config["filter_type"]: filter_config["value"]})
+        for filter_config in filter_list
+        if filter_config["filter_type"] in ("gl", "location")
+    )
+    for worksheet_name, filter_list in TARGET_LOCATIONS.items()
+}
+
 SERVICE_ACCOUNT_KEY_FILE = "service_account_key.json"
+BLOOM_FILTER_PATH = "/tmp/bloom_{}.bin"
+BLOOM_FILTER_CAPACITY = 100_000
+BLOOM_FILTER_ERROR_RATE = 0.001
+CHECKED_IDS_PATH = "/tmp/checked_{}.txt"
+SEEN_JOBS_SYNCED_AT_PATH = "/tmp/seen_jobs_synced_at.txt"
+BLOOM_SYNC_OVERLAP = datetime.timedelta(minutes=5)
 COMPETITOR_NAMES = ["ITS", "Google"]
+COLUMNS = ["job_id", "Role Category", "Title", "Company Name", "Source URL", "Location of Job", "Compensation", "Job Description", "Apply Link"]
+# Jobs are kept as tuples in COLUMNS order from ingest through to the sheet write.
+JOB_ID_INDEX = COLUMNS.index("job_id")
+ROLE_CATEGORY_INDEX = COLUMNS.index("Role Category")
+TITLE_INDEX = COLUMNS.index("Title")
+DESCRIPTION_INDEX = COLUMNS.index("Job Description")
+COMPANY_NAME_INDEX = COLUMNS.index("Company Name")
+# Whole-word match so that e.g. "ITS" does not filter out "BITSY".
+COMPETITOR_RE = re.compile(r'\b(?:' + '|'.join(map(re.escape, COMPETITOR_NAMES)) + r')\b', re.IGNORECASE) if COMPETITOR_NAMES else None
 
 def categorize_job_role(title, description):
     """Uses Gemini to categorize the job into one of the predefined GCP roles."""
@@ -78,146 +139,486 @@ def categorize_job_role(title, description):
         ]
         return category if any(role in category for role in valid_roles) else "Other"
     except Exception as e:
-        print(f"AI Categorization Error: {e}")
+        logger.error("AI Categorization Error: %s", e)
         return "Unknown"
 
 def filter_competitors(jobs_list: list) -> list:
-    """Filters out jobs where the company name contains a competitor keyword."""
-    competitor_keywords = [name.upper() for name in COMPETITOR_NAMES]
+    """Filters out job rows where the company name contains a competitor name as a whole word."""
     filtered_jobs = []
+    removed = collections.Counter()
     for job in jobs_list:
-        company_name = job.get("company_name", "").upper()
-        is_competitor = False
-        for keyword in competitor_keywords:
-            if keyword in company_name:
-                is_competitor = True
-                print(f"--- FILTERED: Removed job '{job.get('title')}' at '{job.get('company_name')}' due to keyword '{keyword}'.")
-                break
-        if not is_competitor:
+        match = COMPETITOR_RE.search(job[COMPANY_NAME_INDEX] or "") if COMPETITOR_RE else None
+        if match:
+            removed[match.group(0).upper()] += 1
+        else:
             filtered_jobs.append(job)
-    print(f"\nFiltering complete. Kept {len(filtered_jobs)} jobs after removing competitors.")
+    logger.info("Filtering complete. Kept %d jobs after removing competitors. Removed by keyword: %s", len(filtered_jobs), dict(removed))
     return filtered_jobs
 
 
-def get_existing_job_ids(gc, worksheet_name) -> set:
-    """Reads the 'job_id' column from the sheet for deduplication."""
+class SheetCache:
+    """Caches the opened spreadsheet and its worksheets so metadata is fetched once per container."""
+
+    def __init__(self, gc):
+        self.spreadsheet = gc.open_by_key(SPREADSHEET_ID)
+        self._worksheets = {}
+
+    def worksheet(self, worksheet_name):
+        if worksheet_name not in self._worksheets:
+            self._worksheets.update({worksheet.title: worksheet for worksheet in self.spreadsheet.worksheets()})
+        if worksheet_name not in self._worksheets:
+            raise gspread.WorksheetNotFound(worksheet_name)
+        return self._worksheets[worksheet_name]
+
+
+class SeenJobCache:
+    """Caches which job IDs of one worksheet are recorded in Firestore, kept in /tmp between warm invocations."""
+
+    def __init__(self, bloom=None, checked_ids=None):
+        # IDs known to be recorded: lookup results, this container's own
+        # writes and the delta sync of everyone else's.
+        self.bloom = bloom or ScalableBloomFilter(initial_capacity=BLOOM_FILTER_CAPACITY, error_rate=BLOOM_FILTER_ERROR_RATE)
+        # IDs already looked up in Firestore at least once.
+        self.checked_ids = checked_ids or set()
+
+
+def load_seen_job_caches(worksheet_names) -> tuple[dict, datetime.datetime | None]:
+    """Loads the seen-job caches and their Firestore sync time left in /tmp by a previous warm invocation."""
+    try:
+        with open(SEEN_JOBS_SYNCED_AT_PATH) as f:
+            synced_at = datetime.datetime.fromisoformat(f.read().strip())
+        caches = {}
+        for worksheet_name in worksheet_names:
+            with open(BLOOM_FILTER_PATH.format(worksheet_name), "rb") as f:
+                bloom = ScalableBloomFilter.fromfile(f)
+            with open(CHECKED_IDS_PATH.format(worksheet_name)) as f:
+                checked_ids = set(f.read().split())
+            caches[worksheet_name] = SeenJobCache(bloom, checked_ids)
+        return caches, synced_at
+    except Exception:
+        # Any missing file means a cold start: empty caches and no sync time.
+        return {worksheet_name: SeenJobCache() for worksheet_name in worksheet_names}, None
+
+
+def save_seen_job_caches(caches: dict, synced_at: datetime.datetime):
+    """Persists the seen-job caches and their sync time to /tmp for the next warm invocation."""
     try:
-        sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(worksheet_name)
-        job_id_column = sheet.col_values(1)[1:] 
-        print(f"Read {len(job_id_column)} existing job IDs from the sheet.")
-        return set(job_id_column)
+        for worksheet_name, cache in caches.items():
+            with open(BLOOM_FILTER_PATH.format(worksheet_name), "wb") as f:
+                cache.bloom.tofile(f)
+            with open(CHECKED_IDS_PATH.format(worksheet_name), "w") as f:
+                f.write("\n".join(cache.checked_ids))
+        # Written last, so a partial save is never paired with a newer sync time.
+        with open(SEEN_JOBS_SYNCED_AT_PATH, "w") as f:
+            f.write(synced_at.isoformat())
     except Exception as e:
-        print(f"Could not read existing job IDs. Starting with an empty set. Error: {e}")
+        logger.warning("Could not save the seen-job caches. Error: %s", e)
+
+
+def sync_seen_job_caches(caches: dict, synced_at: datetime.datetime | None) -> datetime.datetime:
+    """Adds the job IDs recorded in Firestore since synced_at to the Bloom filters and returns the new sync time."""
+    # Step back a little so writes committed around the query are not missed;
+    # re-adding an ID to a Bloom filter is harmless.
+    started_at = datetime.datetime.now(datetime.timezone.utc) - BLOOM_SYNC_OVERLAP
+    if synced_at is None:
+        # Cold start: the caches are empty, so every candidate is looked up
+        # by document ID instead of streaming the whole collection.
+        return started_at
+    query = seen_ref.select(["worksheet", "job_id"]).where(filter=firestore.FieldFilter("created_at", ">", synced_at))
+    synced = 0
+    for snapshot in query.stream():
+        data = snapshot.to_dict()
+        cache = caches.get(data.get("worksheet"))
+        if cache is not None and data.get("job_id"):
+            cache.bloom.add(data["job_id"])
+            synced += 1
+    logger.info("Synced %d job IDs recorded in Firestore since the last run.", synced)
+    return started_at
+
+
+def _seen_job_doc(worksheet_name, job_id):
+    """Returns the Firestore document that records job_id as written to worksheet_name."""
+    # SerpAPI job IDs are base64 and may contain "/", which Firestore
+    # document IDs cannot, so key the document by a digest instead.
+    digest = hashlib.sha256(job_id.encode()).hexdigest()
+    return seen_ref.document(f"{worksheet_name}-{digest}")
+
+
+def get_existing_job_ids(worksheet_name, candidate_ids: set, cache: SeenJobCache) -> set:
+    """Returns the candidate job IDs already written to the worksheet."""
+    # A Bloom filter miss is only trusted for IDs looked up before, since
+    # anything recorded after that arrives through the delta sync. Hits can
+    # be false positives, so they are always confirmed.
+    lookup_ids = {job_id for job_id in candidate_ids if job_id in cache.bloom or job_id not in cache.checked_ids}
+    logger.info("%s: %d of %d job IDs need a Firestore lookup.", worksheet_name, len(lookup_ids), len(candidate_ids))
+    if not lookup_ids:
         return set()
 
+    doc_refs = {}
+    for job_id in lookup_ids:
+        doc_ref = _seen_job_doc(worksheet_name, job_id)
+        doc_refs[doc_ref.id] = (doc_ref, job_id)
+    existing_ids = {
+        doc_refs[snapshot.id][1]
+        for snapshot in db.get_all([doc_ref for doc_ref, _ in doc_refs.values()])
+        if snapshot.exists
+    }
+    cache.checked_ids.update(lookup_ids)
+    for job_id in existing_ids:
+        cache.bloom.add(job_id)
+    logger.info("%s: Firestore has %d of the %d looked-up job IDs.", worksheet_name, len(existing_ids), len(lookup_ids))
+    return existing_ids
+
 
-def write_jobs_to_sheet(gc, jobs_to_write: list, worksheet_name) -> int:
-    """Appends new job records to the Google Sheet."""
-    if not jobs_to_write:
+def record_job_ids(job_ids_by_sheet: dict):
+    """Records the job IDs written to each worksheet in Firestore for later deduplication."""
+    doc_sets = [
+        (_seen_job_doc(worksheet_name, job_id), {
+            "worksheet": worksheet_name,
+            "job_id": job_id,
+            "created_at": firestore.SERVER_TIMESTAMP,
+        })
+        for worksheet_name, job_ids in job_ids_by_sheet.items()
+        for job_id in job_ids
+    ]
+    for start in range(0, len(doc_sets), FIRESTORE_BATCH_LIMIT):
+        for attempt in range(FIRESTORE_MAX_RETRIES + 1):
+            batch = db.batch()
+            for doc_ref, data in doc_sets[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.set(doc_ref, data)
+            try:
+                batch.commit()
+                break
+            except Exception as e:
+                # An unrecorded ID would be appended to the sheet again, so
+                # the final failure is raised rather than logged.
+                if attempt == FIRESTORE_MAX_RETRIES:
+                    raise
+                logger.warning("Firestore batch commit failed, retrying. Error: %s", e)
+                time.sleep(FIRESTORE_BACKOFF_FACTOR * 2 ** attempt)
+
+
+_seeded_worksheets = set()
+
+
+def seed_seen_jobs(gc, worksheet_names):
+    """Copies a worksheet's existing job IDs into Firestore unless a completed seed is marked for it."""
+    # Sheets filled before the seen-jobs collection existed would otherwise
+    # look empty to the dedup step.
+    for worksheet_name in worksheet_names:
+        if worksheet_name in _seeded_worksheets:
+            continue
+        seed_ref = seeds_ref.document(worksheet_name)
+        if not seed_ref.get().exists:
+            rows = _get_sheets(gc).spreadsheet.values_get(
+                absolute_range_name(worksheet_name, "A2:A"),
+                params={"valueRenderOption": "UNFORMATTED_VALUE"},
+            ).get("values", [])
+            job_ids = {str(row[0]) for row in rows if row}
+            record_job_ids({worksheet_name: job_ids})
+            # Only marked once every batch is in, so a failed seed is redone
+            # on the next run; re-recording an ID is harmless.
+            seed_ref.set({"seeded_at": firestore.SERVER_TIMESTAMP, "job_ids": len(job_ids)})
+            logger.info("%s: seeded Firestore with %d job IDs from the sheet.", worksheet_name, len(job_ids))
+        _seeded_worksheets.add(worksheet_name)
+
+
+def prepare_dedup(gc, caches: dict, synced_at: datetime.datetime | None) -> datetime.datetime:
+    """Seeds Firestore from the sheets if needed, then syncs the seen-job caches from it."""
+    seed_seen_jobs(gc, list(caches))
+    return sync_seen_job_caches(caches, synced_at)
+
+
+def _cell(value) -> dict:
+    """Builds a literal string cell, the appendCells equivalent of RAW input."""
+    if value is None or value == "":
+        return {}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def write_jobs_to_sheets(sheets: SheetCache, jobs_by_sheet: dict) -> int:
+    """Appends new job records to every worksheet with one spreadsheets.batchUpdate call."""
+    jobs_by_sheet = {name: jobs for name, jobs in jobs_by_sheet.items() if jobs}
+    if not jobs_by_sheet:
         return 0
     try:
-        sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(worksheet_name)
-        columns = ["job_id", "Role Category", "Title", "Company Name", "Source URL", "Location of Job", "Compensation", "Job Description", "Apply Link"]
-        data_to_append = [
-            [job.get(col, "") for col in columns] for job in jobs_to_write
-        ]
-        sheet.insert_rows(data_to_append, row=2, value_input_option='USER_ENTERED')
-        return len(jobs_to_write)
+        # appendCells adds rows after the last row with data, without the
+        # insertDimension row shift that insert_rows needs.
+        sheets.spreadsheet.batch_update({"requests": [
+            {
+                "appendCells": {
+                    "sheetId": sheets.worksheet(worksheet_name).id,
+                    "rows": [{"values": [_cell(value) for value in job]} for job in jobs],
+                    "fields": "userEnteredValue",
+                }
+            }
+            for worksheet_name, jobs in jobs_by_sheet.items()
+        ]})
+        return sum(len(jobs) for jobs in jobs_by_sheet.values())
     except Exception as e:
-        print(f"Error writing to Google Sheets: {e}")
+        logger.error("Error writing to Google Sheets: %s", e)
         raise
 
 
-@functions_framework.http
-def fetch_and_process_jobs(request):
+def _apply_link(job) -> str:
+    """Returns the first apply option link, falling back to the share link."""
+    apply_options = job.get("apply_options")
+    if apply_options and apply_options[0].get("link"):
+        return apply_options[0]["link"]
+    return job.get("share_link", "N/A")
+
+
+async def fetch_page(client, semaphore, params) -> dict:
+    """Fetches a single SerpAPI results page, bounded by the shared semaphore."""
+    # Rate-limit and 5xx responses are retried with exponential backoff.
+    for attempt in range(SERPAPI_MAX_RETRIES + 1):
+        async with semaphore:
+            response = await client.get(SERPAPI_URL, params=params)
+        if response.status_code not in SERPAPI_RETRY_STATUSES or attempt == SERPAPI_MAX_RETRIES:
+            break
+        await asyncio.sleep(SERPAPI_BACKOFF_FACTOR * 2 ** attempt)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+async def fetch_location_jobs(client, semaphore, filter_value, location_params: dict, aggregated_raw_job_data: list, seen_job_ids: set):
+    """Pages through SerpAPI results for one location filter, appending job rows in COLUMNS order."""
+    logger.info("  > Fetching data for filter: %s", filter_value)
+
+    next_page_token = None
+    page_task = asyncio.create_task(fetch_page(client, semaphore, location_params))
+
     try:
-        gc = gspread.service_account(filename=SERVICE_ACCOUNT_KEY_FILE)
-    except Exception as e:
-        return f"FATAL ERROR: Could not initialize Google Sheets client: {e}", 500
-    
-    for worksheet_name, filter_list in TARGET_LOCATIONS.items():
-        aggregated_raw_job_data = []
-        for filter_config in filter_list:
-            filter_type = filter_config["filter_type"]
-            filter_value = filter_config["value"]
-            
-            print(f"  > Fetching data for filter: {filter_value}")
-            
-            next_page_token = None
-            
-            while True:
-                try:
-                    params = {
-                        "engine": "google_jobs",
-                        "q": '"GCP" OR "Google Cloud Platform" OR "Google Cloud" OR "Google Cloud Engineer" OR "Google Cloud Architect" OR "Google Cloud Developer" OR "Google Cloud Specialist" OR "Google Cloud Consultant" OR "Google Cloud Professional"',
-                        "api_key": SERPAPI_API_KEY,
-                        "hl": "en",
-                        "num": RESULTS_PER_PAGE
-                    }
-                    
-                    if filter_type == "gl":
-                        params["gl"] = filter_value
-                    elif filter_type == "location":
-                        params["location"] = filter_value
-                    
-                    if next_page_token:
-                        params["next_page_token"] = next_page_token
-                        
-                    response = requests.get(SERPAPI_URL, params=params)
-                    response.raise_for_status()
-                    data = response.json()
-                    
-                    if 'jobs_results' in data and data['jobs_results']:
-                        for job in data['jobs_results']:
-                            job_description = job.get("description", "No description provided")
-                            role_category = categorize_job_role(job.get("title"), job_description)
-                            aggregated_raw_job_data.append({
-                                "job_id": job.get("job_id"),
-                                "Role Category": role_category,
-                                "Title": job.get("title"),
-                                "Company Name": job.get("company_name"),
-                                "Location of Job": job.get("location", "N/A"),
-                                "Compensation": job.get("detected_extensions", {}).get("salary", "N/A"),
-                                "Source URL": job.get("share_link", "N/A"),
-                                "Apply Link": job.get("apply_options", [{}])[0].get("link", job.get("share_link", "N/A")),
-                                "Job Description": job_description,
-                            })
-                        
+        while True:
+            try:
+                data = await page_task
+                page_task = None
+
+                if 'jobs_results' in data and data['jobs_results']:
+                    pagination_data = data.get("serpapi_pagination", {})
+                    following_page_token = pagination_data.get("next_page_token")
+                    # Prefetch the next page while this one is processed, but only
+                    # when this page cannot fill the budget on its own, since every
+                    # request sent is a billed search.
+                    if following_page_token and len(aggregated_raw_job_data) + len(data['jobs_results']) < MAX_JOBS_TO_FETCH:
+                        page_task = asyncio.create_task(fetch_page(
+                            client, semaphore, {**location_params, "next_page_token": following_page_token}
+                        ))
+
+                    for job in data['jobs_results']:
                         if len(aggregated_raw_job_data) >= MAX_JOBS_TO_FETCH:
-                            print(f"Reached maximum job limit of {MAX_JOBS_TO_FETCH}. Exiting loop.")
                             break
+                        # These keys are present on almost every SerpAPI job, so
+                        # index directly and only fall back to .get() when one is missing.
+                        try:
+                            job_id = job["job_id"]
+                            title = job["title"]
+                            company_name = job["company_name"]
+                        except KeyError:
+                            job_id = job.get("job_id")
+                            title = job.get("title")
+                            company_name = job.get("company_name")
+                        # Overlapping locations return some of the same jobs.
+                        if not job_id or job_id in seen_job_ids:
+                            continue
+                        seen_job_ids.add(job_id)
+                        job_description = job.get("description", "No description provided")
+                        detected_extensions = job.get("detected_extensions") or {}
+                        aggregated_raw_job_data.append((
+                            job_id,
+                            None,  # Role Category, filled in once the region's new jobs are known.
+                            title,
+                            company_name,
+                            job.get("share_link", "N/A"),
+                            job.get("location", "N/A"),
+                            detected_extensions.get("salary", "N/A"),
+                            job_description,
+                            _apply_link(job),
+                        ))
 
-                        pagination_data = data.get("serpapi_pagination", {})
-                        next_page_token = pagination_data.get("next_page_token")
-                        
-                        if not next_page_token:
-                            print("Pagination complete. No next page token found.")
-                            break
-                            
-                    else:
-                        print("No more results found in the latest fetch.")
+                    if len(aggregated_raw_job_data) >= MAX_JOBS_TO_FETCH:
+                        logger.info("Reached maximum job limit of %d. Exiting loop.", MAX_JOBS_TO_FETCH)
                         break
-                        
-                except Exception as e:
-                    return f"Error during Step 1 (Talent API Fetch) with token {next_page_token}: {e}", 500
-                
-        print(f"Step 1: Fetched {len(aggregated_raw_job_data)} raw job listings.")            
-        
-        filtered_jobs = filter_competitors(aggregated_raw_job_data)
-        print(f"Step 2: Filtered down to {len(filtered_jobs)} non-competitor jobs.")
-        
-        existing_ids = get_existing_job_ids(gc, worksheet_name)
-        new_jobs_to_add = []
-        for job in filtered_jobs:
-            if job.get("job_id") and job["job_id"] not in existing_ids:
-                new_jobs_to_add.append(job)
-        print(f"Deduplication: {len(new_jobs_to_add)} truly new jobs found for saving.")
-        
-        rows_written = 0
-        if new_jobs_to_add:
-            try:
-                rows_written = write_jobs_to_sheet(gc, new_jobs_to_add, worksheet_name)
+
+                    if not following_page_token:
+                        logger.info("Pagination complete for %s. No next page token found.", filter_value)
+                        break
+                    next_page_token = following_page_token
+                    if page_task is None:
+                        # Not prefetched because the page could have filled the
+                        # budget, but duplicates left room for another one.
+                        page_task = asyncio.create_task(fetch_page(
+                            client, semaphore, {**location_params, "next_page_token": following_page_token}
+                        ))
+
+                else:
+                    logger.info("No more results found in the latest fetch for %s.", filter_value)
+                    break
+
             except Exception as e:
-                return f"Error during Step 3 (Google Sheets Write): {e}", 500
+                raise RuntimeError(f"Error during Step 1 (Talent API Fetch) with token {next_page_token}: {e}") from e
+    finally:
+        # Drop a prefetched page that will not be used.
+        if page_task:
+            page_task.cancel()
+
+
+async def fetch_region_jobs(client, semaphore, filter_params) -> list:
+    """Fetches all location filters of a region concurrently."""
+    # Pages are chained through next_page_token, so each location pages
+    # serially while the locations themselves run side by side.
+    aggregated_raw_job_data = []
+    seen_job_ids = set()
+    await asyncio.gather(*(
+        fetch_location_jobs(client, semaphore, filter_value, location_params, aggregated_raw_job_data, seen_job_ids)
+        for filter_value, location_params in filter_params
+    ))
+    # Locations append concurrently, so trim the few jobs that landed after
+    # another location filled the budget.
+    del aggregated_raw_job_data[MAX_JOBS_TO_FETCH:]
+    return aggregated_raw_job_data
+
+
+async def categorize_jobs(jobs: list) -> list:
+    """Fills in the Role Category of each job row using Gemini."""
+    # Gemini calls are blocking, so run them off the event loop.
+    categories = await asyncio.gather(*(
+        asyncio.to_thread(categorize_job_role, job[TITLE_INDEX], job[DESCRIPTION_INDEX]) for job in jobs
+    ))
+    return [
+        job[:ROLE_CATEGORY_INDEX] + (category,) + job[ROLE_CATEGORY_INDEX + 1:]
+        for job, category in zip(jobs, categories)
+    ]
+
+
+async def _process_region(client, semaphore, worksheet_name, filter_params, seen_cache, dedup_ready) -> tuple[int, list]:
+    """Returns the number of raw jobs fetched for one region and its new, categorized non-competitor rows."""
+    aggregated_raw_job_data = await fetch_region_jobs(client, semaphore, filter_params)
+    logger.info("Step 1: Fetched %d raw job listings for %s.", len(aggregated_raw_job_data), worksheet_name)
+
+    # Deduplicate first so the competitor regex and the Gemini calls only see
+    # jobs not already in the sheet. The Firestore lookup runs off the event
+    # loop, overlapping the other regions' SerpAPI fetches.
+    try:
+        await dedup_ready
+        existing_ids = await asyncio.to_thread(
+            get_existing_job_ids,
+            worksheet_name,
+            {job[JOB_ID_INDEX] for job in aggregated_raw_job_data},
+            seen_cache,
+        )
+    except Exception as e:
+        raise RuntimeError(f"Error during Step 2 (Deduplication): {e}") from e
+    new_jobs = [job for job in aggregated_raw_job_data if job[JOB_ID_INDEX] not in existing_ids]
+    logger.info("Step 2: Deduplication found %d truly new jobs for %s.", len(new_jobs), worksheet_name)
+
+    filtered_jobs = filter_competitors(new_jobs)
+    logger.info("Step 3: Filtered down to %d new non-competitor jobs for %s.", len(filtered_jobs), worksheet_name)
+
+    new_jobs_to_add = await categorize_jobs(filtered_jobs)
+    logger.info("Step 4: Categorized %d new jobs for %s.", len(new_jobs_to_add), worksheet_name)
+    return len(aggregated_raw_job_data), new_jobs_to_add
+
+
+async def _async_main(gc):
+    seen_caches, synced_at = load_seen_job_caches(FILTER_PARAMS)
+    # One pooled client per run keeps TLS connections to serpapi.com alive
+    # across pages; the transport retries failed connection attempts.
+    transport = httpx.AsyncHTTPTransport(
+        retries=SERPAPI_MAX_RETRIES,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    )
+    # The regions are independent, so run them side by side. They share one
+    # semaphore so the SerpAPI concurrency limit holds for the whole run.
+    semaphore = asyncio.Semaphore(SERPAPI_CONCURRENCY)
+    # Seeding Firestore and syncing the seen-job caches from it overlap the
+    # SerpAPI fetches; each region's dedup waits for them.
+    dedup_ready = asyncio.create_task(asyncio.to_thread(prepare_dedup, gc, seen_caches, synced_at))
+    async with httpx.AsyncClient(timeout=SERPAPI_TIMEOUT, transport=transport) as client:
+        # A failing region cancels the others before the client is closed.
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                region_tasks = [
+                    task_group.create_task(
+                        _process_region(client, semaphore, worksheet_name, filter_params, seen_caches[worksheet_name], dedup_ready)
+                    )
+                    for worksheet_name, filter_params in FILTER_PARAMS.items()
+                ]
+        except ExceptionGroup as eg:
+            dedup_ready.cancel()
+            return f"{eg.exceptions[0]}", 500
+
+    region_results = [task.result() for task in region_tasks]
+    total_fetched = sum(fetched_count for fetched_count, _ in region_results)
+    new_jobs_by_sheet = {
+        worksheet_name: new_jobs_to_add
+        for worksheet_name, (_, new_jobs_to_add) in zip(FILTER_PARAMS, region_results)
+    }
+
+    rows_written = 0
+    if any(new_jobs_by_sheet.values()):
+        try:
+            rows_written = write_jobs_to_sheets(_get_sheets(gc), new_jobs_by_sheet)
+        except Exception as e:
+            # A worksheet may have been deleted or recreated since it was cached.
+            _reset_sheets()
+            return f"Error during Step 5 (Google Sheets Write): {e}", 500
+        try:
+            record_job_ids({
+                worksheet_name: [job[JOB_ID_INDEX] for job in new_jobs_to_add]
+                for worksheet_name, new_jobs_to_add in new_jobs_by_sheet.items()
+            })
+        except Exception as e:
+            return f"Error during Step 6 (Firestore Record) after writing {rows_written} rows: {e}", 500
+
+    for worksheet_name, new_jobs_to_add in new_jobs_by_sheet.items():
+        for job in new_jobs_to_add:
+            seen_caches[worksheet_name].bloom.add(job[JOB_ID_INDEX])
+    save_seen_job_caches(seen_caches, dedup_ready.result())
+
+    total_new = sum(len(new_jobs_to_add) for new_jobs_to_add in new_jobs_by_sheet.values())
+    return f"SUCCESS: Agent run complete. Fetched {total_fetched} raw jobs, found {total_new} new non-competitors, and added {rows_written} new unique jobs to the sheet."
+
+
+_gc = None
+
+
+def _get_gc():
+    """Returns the Google Sheets client, created once per container and reused on warm starts."""
+    global _gc
+    if _gc is None:
+        # The key file is only present when deployed with the function;
+        # otherwise use the runtime's default credentials.
+        if os.path.exists(SERVICE_ACCOUNT_KEY_FILE):
+            _gc = gspread.service_account(filename=SERVICE_ACCOUNT_KEY_FILE)
+        else:
+            credentials, _ = google.auth.default(scopes=gspread.auth.DEFAULT_SCOPES)
+            _gc = gspread.authorize(credentials)
+    return _gc
+
+
+_sheets = None
+
+
+def _get_sheets(gc) -> SheetCache:
+    """Returns the SheetCache, opened once per container and reused on warm starts."""
+    global _sheets
+    if _sheets is None:
+        _sheets = SheetCache(gc)
+    return _sheets
+
+
+def _reset_sheets():
+    """Drops the cached spreadsheet so the next run re-reads its metadata."""
+    global _sheets
+    _sheets = None
+
+
+@functions_framework.http
+def fetch_and_process_jobs(request):
+    try:
+        gc = _get_gc()
+    except Exception as e:
+        return f"FATAL ERROR: Could not initialize Google Sheets client: {e}", 500
 
-    return f"SUCCESS: Agent run complete. Fetched {len(aggregated_raw_job_data)} raw jobs, found {len(filtered_jobs)} non-competitors, and added {rows_written} new unique jobs to the sheet."
\ No newline at end of file
+    return asyncio.run(_async_main(gc))